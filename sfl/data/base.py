@@ -1,70 +1,327 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from functools import partial
 
+import numpy as np
 import torch
-from datasets import disable_progress_bar
-from torch.utils.data import DataLoader
+from datasets import disable_progress_bar, Value
+from torch.utils.data import DataLoader, Sampler
 
 from sfl.utils.data import random_slicing
 from sfl.utils.exp import get_dra_train_label, get_dra_test_label
 
 
+class BucketBatchSampler(Sampler):
+    """
+    Batches of examples with similar lengths, to reduce padding.
+    Indices are shuffled and cut into buckets of bucket_size, each bucket is sorted by length and split into batches,
+    then the batch order is shuffled
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=None, shuffle=True):
+        super().__init__(None)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        if bucket_size is None:
+            bucket_size = batch_size * 50
+        # whole batches per bucket, so only the last batch can be short
+        self.bucket_size = max(batch_size, bucket_size // batch_size * batch_size)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        idx = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(idx), self.bucket_size):
+            bucket = idx[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches += [bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader of dict batches: the tensors of the next batch are copied to the device on a side CUDA stream
+    while the current batch is being consumed
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        for k, v in batch.items():
+            if isinstance(v, torch.Tensor):
+                batch[k] = v.to(self.device, non_blocking=True)
+        return batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        main_stream = torch.cuda.current_stream(self.device)
+        iterator = iter(self.loader)
+
+        def _load():
+            raw = next(iterator, None)
+            if raw is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(raw)
+
+        nxt = _load()
+        while nxt is not None:
+            main_stream.wait_stream(stream)
+            batch = nxt
+            for v in batch.values():
+                if isinstance(v, torch.Tensor):
+                    v.record_stream(main_stream)
+            nxt = _load()
+            yield batch
+
+
 class FedDataset(ABC):
     """
     Federated (Split) Learning Dataset
     """
+    # text columns tokenized once in _pre_process instead of at every collation
+    pre_tokenized_columns: tuple[str, ...] = ()
+    # batches are padded to the longest sequence, rounded up to a multiple of this when set (tensor-core friendly
+    # shapes); opt-in, as the LM paths train on labels=input_ids and the extra pad tokens would enter the loss
+    pad_to_multiple_of: int | None = None
+    # worker processes for the pre-processing maps, used once there is at least one writer batch per worker
+    pre_process_num_proc: int = 4
+    pre_process_writer_batch_size: int = 2000
+    # texts memoized by collators that tokenize per batch (collation fallback, entity lists)
+    token_cache_size: int = 4096
 
     def __init__(self, tokenizer, client_ids: list[str], dataset, types: list[str], shrink_frac=1.0,
-                 num_labels=0, completion_only=False, uni_length: int = -1):
+                 num_labels=0, completion_only=False, uni_length: int = -1, keep_full: bool = True):
         self.tokenizer = tokenizer
         self.client_ids = client_ids
         self.client_data_indices = {}
+        self.client_datasets = {}  # per-client selections, built once
+        self._loader_cache = {}  # per-client loaders, reused across rounds
         self.all_dataset = dataset
         self.dataset = {}
         self.completion_only = completion_only
         self.num_labels = num_labels
         self.uni_length = uni_length
+        self.shrink_frac = shrink_frac
         for type in types:
-            self.dataset[type] = self.all_dataset[type].select(range(int(len(self.all_dataset[type]) * shrink_frac)))
-            sliced = random_slicing(range(len(self.dataset[type])), len(client_ids), sgm=0.15)
+            self.dataset[type] = self._select_shrunk(type, shrink_frac)
+            if not keep_full and shrink_frac < 1:
+                # materialize the slice, so that the full split is not referenced by its indices mapping
+                self.dataset[type] = self.dataset[type].flatten_indices()
+            sliced = random_slicing(np.arange(len(self.dataset[type]), dtype=np.int64), len(client_ids), sgm=0.15)
             disable_progress_bar()
             self.client_data_indices[type] = {cid: sliced[i] for i, cid in enumerate(client_ids)}
+            self.client_datasets[type] = {cid: self.dataset[type].select(sliced[i], keep_in_memory=True)
+                                          for i, cid in enumerate(client_ids)}
+        if not keep_full:
+            # only the shrunk splits are kept, unsliced access is limited to them
+            self.all_dataset = None
+
+    def __getstate__(self):
+        # the collate and map functions are bound methods, so the instance is pickled to loader workers and hashed
+        # into map fingerprints; cached loaders (whose live worker iterators cannot be pickled) and memoized tokens
+        # stay in this process, so that pickling works and fingerprints do not change as the caches grow
+        state = self.__dict__.copy()
+        state['_loader_cache'] = {}
+        state.pop('_token_cache', None)
+        return state
+
+    def get_dataloader(self, client_id, batch_size=1, type='train', max_seq_len=-1, pin_memory=None, num_workers=0,
+                       prefetch_factor=4, persistent_workers=True, bucket_by_length=False, device=None):
+        """
+        Batches are pinned by default when CUDA is available; move them with .to(device, non_blocking=True)
+        so that the H2D copy overlaps with compute, or pass a CUDA device to have them prefetched there.
+        With bucket_by_length, examples of similar token lengths are batched together (pre-tokenized datasets only).
+        Loaders are cached per client and arguments, so persistent workers survive across rounds
+        """
+        key = (client_id, type, batch_size, max_seq_len, pin_memory, num_workers, prefetch_factor, persistent_workers,
+               bucket_by_length, None if device is None else str(device))
+        if key in self._loader_cache:
+            return self._loader_cache[key]
+        ds = self.client_datasets[type][client_id]
+        loader = self._make_dataloader(self._pre_process(ds, batch_size), batch_size, True, max_seq_len,
+                                       pin_memory, num_workers, prefetch_factor, persistent_workers, bucket_by_length)
+        if device is not None and torch.device(device).type == 'cuda':
+            loader = CUDAPrefetcher(loader, device)
+        self._loader_cache[key] = loader
+        return loader
 
-    def get_dataloader(self, client_id, batch_size=1, type='train', max_seq_len=-1):
-        ds = self.dataset[type].select(self.client_data_indices[type][client_id])
-        return DataLoader(self._pre_process(ds, batch_size),
-                          collate_fn=lambda x: self._col_fun(x, max_seq_len=max_seq_len),
-                          batch_size=batch_size,
-                          shuffle=True)
+    def _select_shrunk(self, type, shrink_frac):
+        """
+        The leading shrink_frac of a split, the slice made at construction is reused when the fraction matches
+        """
+        if shrink_frac == self.shrink_frac and type in self.dataset:
+            return self.dataset[type]
+        if self.all_dataset is None:
+            raise ValueError(f'Split {type} with shrink_frac={shrink_frac} requested, but the full dataset was released '
+                             f'(keep_full=False), only the splits shrunk at construction are available')
+        return self.all_dataset[type].select(range(int(len(self.all_dataset[type]) * shrink_frac)),
+                                             keep_in_memory=True)
 
     def as_dataset_and_collator(self, type='train', shrink_frac=1.0):
-        ds = self.all_dataset[type].select(range(int(len(self.all_dataset[type]) * shrink_frac)))
+        ds = self._select_shrunk(type, shrink_frac)
         ds = self._pre_process(ds, 1)
         return ds, partial(self._col_fun, extra_info=False)
 
     def get_dataloader_unsliced(self, batch_size=2, type='train', shrink_frac=1.0, further_test_split=None,
-                                max_seq_len=-1, shuffle=True):
-        ds = self.all_dataset[type].select(range(int(len(self.all_dataset[type]) * shrink_frac)))
+                                max_seq_len=-1, shuffle=True, pin_memory=None, num_workers=0, prefetch_factor=4,
+                                persistent_workers=True):
+        loader_args = (max_seq_len, pin_memory, num_workers, prefetch_factor, persistent_workers)
+        ds = self._select_shrunk(type, shrink_frac)
         if further_test_split is not None:
             ds_split = ds.train_test_split(shuffle=shuffle, test_size=further_test_split)
-            return DataLoader(self._pre_process(ds_split['train'], batch_size),
-                              collate_fn=lambda x: self._col_fun(x, max_seq_len=max_seq_len),
-                              batch_size=batch_size,
-                              shuffle=shuffle), \
-                DataLoader(self._pre_process(ds_split['test'], batch_size),
-                           collate_fn=lambda x: self._col_fun(x, max_seq_len=max_seq_len),
-                           batch_size=batch_size, shuffle=shuffle)
-        return DataLoader(self._pre_process(ds, batch_size), batch_size=batch_size, shuffle=shuffle,
-                          collate_fn=lambda x: self._col_fun(x, max_seq_len=max_seq_len))
+            return self._make_dataloader(self._pre_process(ds_split['train'], batch_size), batch_size, shuffle,
+                                         *loader_args), \
+                self._make_dataloader(self._pre_process(ds_split['test'], batch_size), batch_size, shuffle,
+                                      *loader_args)
+        return self._make_dataloader(self._pre_process(ds, batch_size), batch_size, shuffle, *loader_args)
+
+    def _make_dataloader(self, ds, batch_size, shuffle, max_seq_len=-1, pin_memory=None, num_workers=0,
+                         prefetch_factor=4, persistent_workers=True, bucket_by_length=False):
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        kwargs = {}
+        if num_workers > 0:
+            # only valid with worker processes
+            kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers}
+        if bucket_by_length and 'input_length' in ds.column_names:
+            kwargs['batch_sampler'] = BucketBatchSampler(ds['input_length'], batch_size, shuffle=shuffle)
+        else:
+            kwargs.update(batch_size=batch_size, shuffle=shuffle)
+        return DataLoader(ds,
+                          collate_fn=partial(self._collate, max_seq_len=max_seq_len),
+                          pin_memory=pin_memory,
+                          num_workers=num_workers,
+                          **kwargs)
 
     def _pre_process(self, ds, batch_size):
-        ds = ds.map(lambda x: self._format(x), batched=False)
-        ds.set_format(type="torch")
+        ds = ds.map(self._format_batch, batched=True, batch_size=1000, **self._map_kwargs(ds))
+        if len(self.pre_tokenized_columns) > 0:
+            ds = self._pre_tokenize(ds, self.pre_tokenized_columns)
+        self._set_torch_format(ds)
         return ds
 
+    @staticmethod
+    def _set_torch_format(ds):
+        """
+        Torch-format only the non-text columns; text columns are returned as python objects without the formatter
+        """
+        columns = [k for k, f in ds.features.items()
+                   if not (isinstance(f, Value) and f.dtype in ['string', 'large_string'])]
+        ds.set_format(type="torch", columns=columns, output_all_columns=True)
+
+    def _format_batch(self, examples):
+        """
+        Batched adapter of _format, so that datasets writes whole columns per call instead of one example at a time
+        """
+        num = len(next(iter(examples.values()), []))
+        rows = [self._format({k: v[i] for k, v in examples.items()}) for i in range(num)]
+        if len(rows) == 0 or rows[0] is None:
+            return {}
+        return {k: [r[k] for r in rows] for k in rows[0]}
+
+    def _pre_tokenize(self, ds, columns):
+        """
+        Tokenize text columns once, in batches, into '<column>_tokens' (without special tokens),
+        so that collation only truncates and pads (see _pad_tokenized); 'input_length' is kept for bucketing
+        """
+
+        def tokenize(examples):
+            res = {f'{c}_tokens': self.tokenizer(examples[c], add_special_tokens=False)['input_ids'] for c in columns}
+            if 'input_tokens' in res:
+                res['input_length'] = [len(t) for t in res['input_tokens']]
+            return res
+
+        return ds.map(tokenize, batched=True, **self._map_kwargs(ds))
+
+    def _map_kwargs(self, ds):
+        kwargs = {'writer_batch_size': self.pre_process_writer_batch_size, 'load_from_cache_file': True}
+        # spawning workers for small (per-client) slices costs more than it saves
+        if self.pre_process_num_proc > 1 and len(ds) >= self.pre_process_num_proc * self.pre_process_writer_batch_size:
+            kwargs['num_proc'] = self.pre_process_num_proc
+        return kwargs
+
+    def _special_ids(self):
+        """
+        (prefix, suffix) special token ids the tokenizer puts around a single sequence, probed once.
+        build_inputs_with_special_tokens is not used: generic fast tokenizers add them in their backend post-processor
+        """
+        if '_special_ids_cache' not in self.__dict__:
+            core = self.tokenizer('a', add_special_tokens=False)['input_ids']
+            full = self.tokenizer('a')['input_ids']
+            start = next((i for i in range(len(full) - len(core) + 1) if full[i:i + len(core)] == core), None)
+            if start is None or len(full) - len(core) != self.tokenizer.num_special_tokens_to_add():
+                raise ValueError(f'Cannot place the special tokens of {type(self.tokenizer).__name__} around '
+                                 f'pre-tokenized texts, set pre_tokenized_columns = () for this dataset')
+            self._special_ids_cache = (full[:start], full[start + len(core):])
+        return self._special_ids_cache
+
+    def _pad_tokenized(self, token_seqs, max_length=None, padding='longest'):
+        """
+        Equivalent of tokenizer(texts, padding=padding, truncation=True, max_length=max_length,
+        pad_to_multiple_of=self.pad_to_multiple_of) on pre-tokenized texts.
+        With padding='max_length', sequences are padded to exactly max_length (no rounding up)
+        """
+        if max_length is None:
+            max_length = self.tokenizer.model_max_length
+        pad_kwargs = {'padding': 'longest', 'pad_to_multiple_of': self.pad_to_multiple_of}
+        if padding == 'max_length':
+            pad_kwargs = {'padding': 'max_length', 'max_length': max_length}
+        prefix, suffix = self._special_ids()
+        max_length = max(max_length - len(prefix) - len(suffix), 0)
+        ids = []
+        for seq in token_seqs:
+            seq = seq.tolist() if isinstance(seq, torch.Tensor) else seq
+            if len(seq) > max_length:
+                seq = seq[len(seq) - max_length:] if self.tokenizer.truncation_side == 'left' else seq[:max_length]
+            ids.append(prefix + seq + suffix)
+        return self.tokenizer.pad({'input_ids': ids}, return_tensors='pt', **pad_kwargs)
+
+    def _uni_padding(self, max_length=None):
+        """
+        (max_length, padding) for _pad_tokenized, all sequences are padded to uni_length when it is set
+        """
+        if self.uni_length > 0:
+            return self.uni_length, 'max_length'
+        return max_length, 'longest'
+
+    def _tokenize_memoized(self, texts):
+        """
+        Token ids (without special tokens) of texts, memoized per text in a bounded LRU, so that texts seen in earlier
+        local epochs are not tokenized again. The memo is not pickled (see __getstate__), each loader worker fills its own
+        """
+        cache = self.__dict__.setdefault('_token_cache', OrderedDict())
+        missing = [t for t in dict.fromkeys(texts) if t not in cache]
+        if len(missing) > 0:
+            cache.update(zip(missing, self.tokenizer(missing, add_special_tokens=False)['input_ids']))
+        res = []
+        for t in texts:
+            cache.move_to_end(t)
+            res.append(cache[t])
+        while len(cache) > self.token_cache_size:
+            cache.popitem(last=False)
+        return res
+
+    def _collate(self, batch, max_seq_len=-1):
+        # a bound method (not a closure), so the collate_fn can be pickled to DataLoader workers
+        return self._col_fun(batch, max_seq_len=max_seq_len)
+
     def _col_fun(self, batch, max_seq_len=-1, extra_info=True):
         texts = [b['input'] for b in batch]
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt')
+        if 'input_tokens' in batch[0]:
+            input = self._pad_tokenized([b['input_tokens'] for b in batch])
+        else:
+            input = self._pad_tokenized(self._tokenize_memoized(texts))
         return {'input_ids': input['input_ids'],
                 'attention_mask': input['attention_mask'],
                 'input_text': texts}
@@ -89,23 +346,25 @@ class MixtureFedDataset(FedDataset):
         for cls in dataset_classes:
             self.fed_datasets.append(cls(tokenizer, client_ids, shrink_frac))
 
-    def get_dataloader(self, client_id, batch_size=1, type='train', max_seq_len=-1):
+    def get_dataloader(self, client_id, batch_size=1, type='train', max_seq_len=-1, **loader_kwargs):
         return CombinedDataLoader(
-            *[ds.get_dataloader(client_id, batch_size, type, max_seq_len=max_seq_len) for ds in self.fed_datasets])
+            *[ds.get_dataloader(client_id, batch_size, type, max_seq_len=max_seq_len, **loader_kwargs)
+              for ds in self.fed_datasets])
 
     def get_dataloader_unsliced(self, batch_size=2, type=None, shrink_frac=1.0, further_test_split=None,
-                                max_seq_len=-1,shuffle=True):
+                                max_seq_len=-1,shuffle=True, **loader_kwargs):
         train_loaders = []
         test_loaders = []
         for nm, ds in zip(self.dataset_names, self.fed_datasets):
             if get_dra_train_label(nm) == get_dra_test_label(nm):
                 d1, d2 = ds.get_dataloader_unsliced(batch_size,get_dra_train_label(nm), shrink_frac,
-                                                    further_test_split=0.3, max_seq_len=max_seq_len,shuffle=shuffle)
+                                                    further_test_split=0.3, max_seq_len=max_seq_len,shuffle=shuffle,
+                                                    **loader_kwargs)
             else:
                 d1 = ds.get_dataloader_unsliced(batch_size, get_dra_train_label(nm), shrink_frac=shrink_frac,
-                                                max_seq_len=max_seq_len,shuffle=shuffle)
+                                                max_seq_len=max_seq_len,shuffle=shuffle, **loader_kwargs)
                 d2 = ds.get_dataloader_unsliced(batch_size, get_dra_test_label(nm), shrink_frac=shrink_frac,
-                                                max_seq_len=max_seq_len,shuffle=shuffle)
+                                                max_seq_len=max_seq_len,shuffle=shuffle, **loader_kwargs)
             train_loaders.append(d1)
             test_loaders.append(d2)
         return CombinedDataLoader(*train_loaders), CombinedDataLoader(*test_loaders)
@@ -1,9 +1,12 @@
 import ast
 from copy import deepcopy
+from itertools import chain
 
+import numpy as np
 import pandas as pd
 import torch
 from datasets import load_dataset, Dataset
+from torch.utils.data import default_collate
 from trl import DataCollatorForCompletionOnlyLM
 
 from sfl import config
@@ -16,6 +19,7 @@ class PIQAFedDataset(FedDataset):
     """
     PIQA Dataset
     """
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'piqa'),
@@ -38,9 +42,9 @@ class PIQAFedDataset(FedDataset):
         texts = [b['input'] for b in batch]
         qs = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt')  # for batch_size testing
-        input_q = self.tokenizer(qs, padding=True, truncation=True, return_tensors='pt')
-        input_a = self.tokenizer(as_, padding=True, truncation=True, return_tensors='pt')
+        input = self._pad_tokenized([b['input_tokens'] for b in batch])  # for batch_size testing
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch])
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch])
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         if not extra_info:
@@ -78,10 +82,9 @@ class PIQAMiniFedDataset(PIQAFedDataset):
         qs = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
         max_len = 128 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt',
-                               max_length=max_len)  # for batch_size testing
-        input_q = self.tokenizer(qs, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        input_a = self.tokenizer(as_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)  # for batch_size testing
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len)
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         return {'input_ids': input['input_ids'],
@@ -97,6 +100,7 @@ class PIQAMiniFedDataset(PIQAFedDataset):
 
 @register_dataset('stsb')
 class STSBFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'stsb'),
@@ -112,11 +116,8 @@ class STSBFedDataset(FedDataset):
 
     def _col_fun(self, batch, max_seq_len=-1, extra_info=True):
         texts = [b['input'] for b in batch]
-        kwargs = {'padding': True, 'truncation': True, 'return_tensors': 'pt'}
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
+        max_len, padding = self._uni_padding()
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
         labels = [b['score'] for b in batch]
         labels = torch.tensor(labels)
         if not extra_info:
@@ -132,6 +133,7 @@ class STSBFedDataset(FedDataset):
 
 @register_dataset('qnli')
 class QNLIFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'qnli'),
@@ -151,13 +153,10 @@ class QNLIFedDataset(FedDataset):
         qs = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
         # pad&truncate all sentence to the same length (self.uni_length)
-        kwargs = {'padding': True, 'truncation': True, 'return_tensors': 'pt'}
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
-        input_q = self.tokenizer(qs, **kwargs)
-        input_a = self.tokenizer(as_, **kwargs)
+        max_len, padding = self._uni_padding()
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len, padding)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len, padding)
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         if not extra_info:
@@ -179,6 +178,7 @@ class QNLIFedDataset(FedDataset):
 
 @register_dataset('mrpc')
 class MRPCFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'mrpc'),
@@ -197,13 +197,10 @@ class MRPCFedDataset(FedDataset):
         texts = [b['input'] for b in batch]
         qs = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        kwargs = {'padding': True, 'truncation': True, 'return_tensors': 'pt'}
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
-        input_q = self.tokenizer(qs, **kwargs)
-        input_a = self.tokenizer(as_, **kwargs)
+        max_len, padding = self._uni_padding()
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len, padding)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len, padding)
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         if not extra_info:
@@ -225,6 +222,7 @@ class MRPCFedDataset(FedDataset):
 
 @register_dataset('cola', dra_train_label='test')
 class CoLAFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'cola'),
@@ -236,11 +234,8 @@ class CoLAFedDataset(FedDataset):
 
     def _col_fun(self, batch, max_seq_len=-1, extra_info=True):
         texts = [b['input'] for b in batch]
-        kwargs = {'padding': True, 'truncation': True, 'return_tensors': 'pt'}
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
+        max_len, padding = self._uni_padding()
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         res_dict = {'input_ids': input['input_ids'],
@@ -252,6 +247,7 @@ class CoLAFedDataset(FedDataset):
 
 @register_dataset('rte')
 class RTEFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, dataset=load_dataset(config.dataset_cache_dir + 'rte'),
@@ -270,13 +266,10 @@ class RTEFedDataset(FedDataset):
         texts = [b['input'] for b in batch]
         qs = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        kwargs = {'padding': True, 'truncation': True, 'return_tensors': 'pt'}
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
-        input_q = self.tokenizer(qs, **kwargs)
-        input_a = self.tokenizer(as_, **kwargs)
+        max_len, padding = self._uni_padding()
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len, padding)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len, padding)
         labels = [b['label'] for b in batch]
         labels = torch.tensor(labels)
         if not extra_info:
@@ -298,6 +291,7 @@ class RTEFedDataset(FedDataset):
 
 @register_dataset('gsm8k', dra_train_label='test')
 class GSM8KFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids,
@@ -313,12 +307,11 @@ class GSM8KFedDataset(FedDataset):
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
         max_len = 300 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt',
-                               max_length=max_len)  # 300, glm 256
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)  # 300, glm 256
         qs_ = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        input_q = self.tokenizer(qs_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        input_a = self.tokenizer(as_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len)
         return {'input_ids': input['input_ids'],
                 'attention_mask': input['attention_mask'],
                 'input_text': texts,
@@ -332,6 +325,7 @@ class GSM8KFedDataset(FedDataset):
 
 @register_dataset('dialogsum')
 class DialogSumFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids,
@@ -348,12 +342,11 @@ class DialogSumFedDataset(FedDataset):
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
         max_len = 400 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, max_length=max_len,  # chatglm 256
-                               return_tensors='pt')
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)  # chatglm 256
         qs_ = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        input_q = self.tokenizer(qs_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        input_a = self.tokenizer(as_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len)
         return {'input_ids': input['input_ids'],
                 'attention_mask': input['attention_mask'],
                 'input_text': texts,
@@ -367,6 +360,7 @@ class DialogSumFedDataset(FedDataset):
 
 @register_dataset('codealpaca', dra_train_label='test')
 class CodeAlpacaFedDataset(FedDataset):
+    pre_tokenized_columns = ('input', 'q', 'a')
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids, load_dataset(config.dataset_cache_dir + 'CodeAlpaca_20K'),
@@ -382,12 +376,11 @@ class CodeAlpacaFedDataset(FedDataset):
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
         max_len = 400 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, max_length=max_len,  # 400, chatglm256
-                               return_tensors='pt')
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)  # 400, chatglm256
         qs_ = [b['q'] for b in batch]
         as_ = [b['a'] for b in batch]
-        input_q = self.tokenizer(qs_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        input_a = self.tokenizer(as_, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
+        input_q = self._pad_tokenized([b['q_tokens'] for b in batch], max_len)
+        input_a = self._pad_tokenized([b['a_tokens'] for b in batch], max_len)
         return {'input_ids': input['input_ids'],
                 'attention_mask': input['attention_mask'],
                 'input_text': texts,
@@ -401,6 +394,7 @@ class CodeAlpacaFedDataset(FedDataset):
 
 @register_dataset('imdb', dra_train_label='unsupervised')
 class IMDBFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
 
     def __init__(self, tokenizer, client_ids: list[str], shrink_frac: float = 0.3, **kwargs):
         super().__init__(tokenizer, client_ids,
@@ -409,15 +403,14 @@ class IMDBFedDataset(FedDataset):
                          shrink_frac, num_labels=2, **kwargs)
 
     def _format(self, example):
-        return {'input': example['text']}
+        # labels become tensors through set_format at pre-processing
+        return {'input': example['text'], 'labels': int(example['label'])}
 
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
         max_len = 512 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        # convert labels to tensor
-        labels = [b['label'] for b in batch]
-        labels = torch.tensor(labels)
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)
+        labels = torch.stack([b['labels'] for b in batch])
         return {'input_ids': input['input_ids'],
                 'attention_mask': input['attention_mask'],
                 'input_text': texts, 'labels': labels}
@@ -429,9 +422,11 @@ class WikiTextFedDataset(FedDataset):
     def _format(self, example):
         pass
 
-    def __init__(self, tokenizer, client_ids: list[str], shrink_frac=0.3, **kwargs):
+    def __init__(self, tokenizer, client_ids: list[str], shrink_frac=0.3, keep_input_text: bool = False, **kwargs):
         dataset = load_dataset(config.dataset_cache_dir + 'wikitext', 'wikitext-2-v1')
         types = ['train', 'test', 'validation']
+        # decode input_text for every block at pre-processing (True), or only for the blocks collated (False)
+        self.keep_input_text = keep_input_text
         super().__init__(tokenizer, client_ids, dataset, types, shrink_frac, **kwargs)
 
     def _pre_process(self, ds, batch_size):
@@ -446,15 +441,17 @@ class WikiTextFedDataset(FedDataset):
             block_size = self.uni_length
 
         def group_texts(examples):
-            concatenated_examples = {k: sum(examples[k], []) for k in examples.keys()}
+            concatenated_examples = {k: np.fromiter(chain.from_iterable(examples[k]), dtype=np.int64)
+                                     for k in examples.keys()}
             total_length = len(concatenated_examples[list(examples.keys())[0]])
             total_length = (total_length // block_size) * block_size
             result = {
-                k: [t[i: i + block_size] for i in range(0, total_length, block_size)]
+                k: t[:total_length].reshape(-1, block_size).tolist()
                 for k, t in concatenated_examples.items()
             }
             result["labels"] = result["input_ids"].copy()
-            result["input_text"] = [self.tokenizer.decode(ii) for ii in result["input_ids"]]
+            if self.keep_input_text:
+                result["input_text"] = [self.tokenizer.decode(ii) for ii in result["input_ids"]]
             result["attention_mask"] = result["attention_mask"]
             return result
 
@@ -464,30 +461,29 @@ class WikiTextFedDataset(FedDataset):
             batch_size=batch_size,
             num_proc=4,
         )
-        lm_datasets.set_format(type="torch")
+        self._set_torch_format(lm_datasets)
         return lm_datasets
 
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
-        res = {}
-        for k in batch[0].keys():
-            ls = [x[k] for x in batch]
-            if isinstance(ls[0], torch.Tensor):
-                res[k] = torch.stack(ls)
-            else:
-                res[k] = ls
+        # tensor columns are stacked, input_text (if kept) is gathered into a list of strings
+        res = default_collate(batch)
+        if 'input_text' not in res:
+            res['input_text'] = self.tokenizer.batch_decode(res['input_ids'])
         return res
 
 
 @register_dataset('wikitext-103')
 class WikiText103FedDataset(WikiTextFedDataset):
-    def __init__(self, tokenizer, client_ids: list[str], shrink_frac=0.3, **kwargs):
+    def __init__(self, tokenizer, client_ids: list[str], shrink_frac=0.3, keep_input_text: bool = False, **kwargs):
         dataset = load_dataset(config.dataset_cache_dir + 'wikitext', 'wikitext-103-v1')
         types = ['train', 'test', 'validation']
+        self.keep_input_text = keep_input_text
         FedDataset.__init__(self, tokenizer, client_ids, dataset, types, shrink_frac, **kwargs)
 
 
 @register_dataset('sensimarked')
 class SensiMarkedFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
 
     def _format(self, example):
         return {'input': example['content'], 'entities': ast.literal_eval(example['entity'])}
@@ -495,13 +491,12 @@ class SensiMarkedFedDataset(FedDataset):
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
         max_len = 300 if max_seq_len < 0 else max_seq_len
-        input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt',
-                               max_length=max_len)  # 300, ChatgGLM bs=2时降低
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len)  # 300, ChatgGLM bs=2时降低
         mask = torch.zeros_like(input['input_ids'])
         for sp, sample in enumerate(batch):
             seq = input['input_ids'][sp].numpy().tolist()
-            r = self.tokenizer(sample['entities'], add_special_tokens=False)
-            for subseq in r.input_ids:
+            # entities recur across local epochs, so their token ids are memoized
+            for subseq in self._tokenize_memoized(sample['entities']):
                 for i in range(len(seq) - len(subseq) + 1):
                     if seq[i:i + len(subseq)] == subseq:
                         mask[sp, i:i + len(subseq)] = 1
@@ -526,18 +521,15 @@ class SensiMarkedFedDataset(FedDataset):
 
 @register_dataset('sensireplaced')
 class SensiReplacedFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
 
     def _format(self, example):
         return {'input': example['sani_gpt4']}
 
     def _col_fun(self, batch, max_seq_len=-1, **kwargs):
         texts = [b['input'] for b in batch]
-        max_len = 300 if max_seq_len < 0 else max_seq_len
-        kwargs = dict(padding=True, truncation=True, return_tensors='pt', max_length=max_len)
-        if self.uni_length > 0:
-            kwargs['max_length'] = self.uni_length
-            kwargs['padding'] = 'max_length'
-        input = self.tokenizer(texts, **kwargs)  # for batch_size testing
+        max_len, padding = self._uni_padding(300 if max_seq_len < 0 else max_seq_len)
+        input = self._pad_tokenized([b['input_tokens'] for b in batch], max_len, padding)  # for batch_size testing
         return {'input_ids': input['input_ids'],
                 'q_ids': input['input_ids'],
                 'a_ids': input['input_ids'],
@@ -564,6 +556,8 @@ class SensiMaskedFedDataset(SensiReplacedFedDataset):
 
 @register_dataset('hc3cn', dra_train_label='baike',dra_test_label='finance')
 class HC3CNFedDataset(FedDataset):
+    pre_tokenized_columns = ('input',)
+
     def __init__(self, tokenizer, client_ids: list[str]):
         dataset = load_dataset('HC3-Chinese')
         super().__init__(tokenizer, client_ids, dataset, ['baike', 'open_qa', 'finance'])
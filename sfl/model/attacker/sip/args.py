@@ -24,6 +24,8 @@ class SIPAttackerArguments:
     target_model_load_bits: int = -1
     larger_better: bool = True
     attack_all_layers: bool = False
+    infer_dtype: str = 'float32'  # inverter precision at attack time: float32, bfloat16 (non-recurrent inverters) or int8 (dynamic, CPU only)
+    compile: bool = False  # torch.compile the inverters for attack-time inference
 
 
 @dataclasses.dataclass
@@ -5,13 +5,13 @@ from tokenizers import Tokenizer
 
 from sfl.model.attacker.base import Attacker
 from sfl.model.attacker.sip.args import SIPAttackerArguments, InversionModelTrainingArgument
-from sfl.model.attacker.sip.inversion_models import get_inverter_class
+from sfl.model.attacker.sip.inversion_models import get_inverter_class, MOEDRInverter
 from sfl.model.attacker.sip.inversion_training import train_inversion_model, train_inversion_model_moe
 from sfl.model.llm.split_model import SplitWrapperModel
 from sfl.simulator.simulator import SFLSimulator, ParamRestored
 from sfl.utils.args import PrefixArgumentParser
 from sfl.utils.exp import required_quantization, get_dra_train_label
-from sfl.utils.model import FLConfigHolder
+from sfl.utils.model import FLConfigHolder, prefetch_to_device
 
 
 class SIPAttacker(Attacker):
@@ -24,6 +24,7 @@ class SIPAttacker(Attacker):
         super().__init__()
         self.inverter_b2tr = None
         self.inverter_tr2t = None
+        self.infer_dtype = None  # dtype the intermediates are cast to before inversion
 
     def parse_arguments(self, args, prefix: str):
         res: SIPAttackerArguments = super().parse_arguments(args, prefix)
@@ -63,6 +64,34 @@ class SIPAttacker(Attacker):
                         llm.train(training)
                 self.inverter_b2tr, self.inverter_tr2t = get_sip_inverter(aargs)
                 assert getattr(self, f'inverter_{choice}') is not None
+        self.inverter_b2tr = self._to_infer_precision(self.inverter_b2tr, aargs.infer_dtype)
+        self.inverter_tr2t = self._to_infer_precision(self.inverter_tr2t, aargs.infer_dtype)
+        if aargs.compile:
+            # inference only (attack runs under no_grad), so blocks can be fused freely;
+            # the forward is compiled in place so that attributes like .device stay reachable
+            for inverter in [self.inverter_b2tr, self.inverter_tr2t]:
+                if inverter is not None:
+                    inverter.forward = torch.compile(inverter.forward)
+
+    def _to_infer_precision(self, inverter, infer_dtype):
+        if inverter is None or infer_dtype == 'float32':
+            return inverter
+        if infer_dtype == 'bfloat16':
+            # the recurrent inverters are only supported in float32 (SIPInverter.forward only upcasts fp16)
+            if any(isinstance(m, torch.nn.RNNBase) for m in inverter.modules()):
+                raise ValueError(f'bfloat16 inference is not supported for the recurrent {type(inverter).__name__}')
+            self.infer_dtype = torch.bfloat16
+            return inverter.to(torch.bfloat16)
+        if infer_dtype == 'int8':
+            if inverter.device.type != 'cpu':
+                raise ValueError(f'int8 dynamic quantization is CPU only, the inverter is on {inverter.device}')
+            return torch.ao.quantization.quantize_dynamic(inverter, {torch.nn.Linear}, dtype=torch.qint8)
+        raise ValueError(f'Unknown inverter precision {infer_dtype}')
+
+    def _invert(self, atk, x):
+        if self.infer_dtype is None:
+            return atk(x)
+        return atk(x.to(self.infer_dtype)).float()
 
     def attack(self, args, aargs: arg_clz, llm: SplitWrapperModel, tokenizer: Tokenizer,
                simulator: SFLSimulator, batch, b2tr_inter,
@@ -75,14 +104,29 @@ class SIPAttacker(Attacker):
                 if atk is None or not getattr(aargs, f'{type}_enable'):
                     continue
                 if aargs.attack_all_layers:
-                    for idx, inter in all_inters.items():
-                        if not isinstance(idx, int):
-                            continue
+                    layer_inters = {idx: inter for idx, inter in all_inters.items() if isinstance(idx, int)}
+                    if llm.type != 'encoder-decoder' and not isinstance(atk, MOEDRInverter) \
+                            and len({inter.fx.shape for inter in layer_inters.values()}) == 1:
+                        # same-shaped layers are stacked along the batch dim and attacked in one call;
+                        # only for inverters that treat samples independently (the MoE gating attention attends
+                        # across dim 0, so stacked layers would mix); chatglm intermediates are seq-first,
+                        # the inverter output is always batch-first
+                        batch_dim = 1 if 'chatglm' in atk.config.target_model else 0
+                        fxs = [inter.fx for inter in layer_inters.values()]
+                        batch_size = fxs[0].shape[batch_dim]
+                        fxs = torch.concat(fxs, dim=batch_dim).to(atk.device)
+                        attacked_all = self._invert(atk, fxs).split(batch_size, dim=0)
+                        for idx, attacked in zip(layer_inters, attacked_all):
+                            attacked_result[f'{type}_{idx}'] = attacked
+                        continue
+                    # the next layer's intermediate is copied to the attacker's device while the current one is attacked
+                    fxs = prefetch_to_device([inter.fx for inter in layer_inters.values()], atk.device)
+                    for idx, fx in zip(layer_inters, fxs):
                         if llm.type == 'encoder-decoder':
-                            attacked = atk(torch.concat([encoder_inter.fx.to(
-                                simulator.device), inter.fx.to(atk.device)], dim=1))
+                            attacked = self._invert(atk, torch.concat([encoder_inter.fx.to(
+                                simulator.device), fx], dim=1))
                         else:
-                            attacked = atk(inter.fx.to(atk.device))
+                            attacked = self._invert(atk, fx)
                         attacked_result[f'{type}_{idx}'] = attacked
                 else:
                     if type == 'b2tr':
@@ -97,10 +141,10 @@ class SIPAttacker(Attacker):
                             inter = tr2t_inter
                     all_i = {k: (x.fx.shape, x.type) for k, x in all_inters.items()}
                     if llm.type == 'encoder-decoder':
-                        attacked = atk(torch.concat([encoder_inter.fx.to(
+                        attacked = self._invert(atk, torch.concat([encoder_inter.fx.to(
                             simulator.device), inter.fx.to(atk.device)], dim=1))
                     else:
-                        attacked = atk(inter.fx.to(atk.device))
+                        attacked = self._invert(atk, inter.fx.to(atk.device))
                     attacked_result[type] = attacked
 
         return attacked_result
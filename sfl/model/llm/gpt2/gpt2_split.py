@@ -35,11 +35,31 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         self.device_map = None
         self.gradient_checkpointing = False
         self._attn_implementation = config._attn_implementation
+        # shared head mask for head_mask=None, only indexed by executed layers so it covers any trimmed n_layer
+        self._none_head_mask = (None,) * config.num_hidden_layers
 
         # Initialize weights and apply final processing
         self.post_init()
 
 
+    def _embed_positions(self, inputs_embeds, position_ids, token_type_ids=None):
+        hidden_states = inputs_embeds + self.wpe(position_ids)
+        if token_type_ids is not None:
+            hidden_states = hidden_states + self.wte(token_type_ids)
+        return self.drop(hidden_states)
+
+    def _get_embed_positions(self):
+        """
+        The position/token-type embedding chain, compiled into fused kernels when fl_config.compile_embedding is set.
+        The lookup of wte stays outside since inject_after_embedding runs in between.
+        """
+        if self.fl_config is None or not self.fl_config.compile_embedding:
+            return self._embed_positions
+        compiled = self.__dict__.get('_compiled_embed_positions')
+        if compiled is None:
+            compiled = self._compiled_embed_positions = torch.compile(self._embed_positions, dynamic=True)
+        return compiled
+
     def forward(
             self,
             input_ids: Optional[torch.LongTensor] = None,
@@ -59,11 +79,22 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         if self.fl_config.split_mode == 'attention':
             output_attentions = True
+        if self.training and self.fl_config is not None:
+            # SFL: the kv cache and per-layer hidden states are never consumed during split training,
+            # only built when explicitly requested
+            use_cache = use_cache if use_cache is not None else False
+            output_hidden_states = output_hidden_states if output_hidden_states is not None else False
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
         use_cache = use_cache if use_cache is not None else self.config.use_cache
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        interrupted = self.fl_config is not None and self.fl_config.attack_mode in ['b2tr', 'tr2t']
+        if interrupted:
+            # SFL: the intercepted intermediate is returned at the split point, nothing else is collected
+            use_cache = False
+            output_attentions = False
+            output_hidden_states = False
 
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
@@ -85,9 +116,14 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         if position_ids is not None:
             position_ids = position_ids.view(-1, input_shape[-1])
 
+        # SFL: forward is interrupted at the split point under attack_mode, later layers never run
+        n_layer = len(self.h)
+        if interrupted:
+            n_layer = self.fl_config.split_point_1 if self.fl_config.attack_mode == 'b2tr' \
+                else self.fl_config.split_point_2 + 1
+
         if past_key_values is None:
             past_length = 0
-            past_key_values = tuple([None] * len(self.h))
         else:
             past_length = past_key_values[0][0].size(-2)
         if position_ids is None:
@@ -111,8 +147,10 @@ class GPT2SplitModel(GPT2Model, SplitModel):
             # positions we want to attend and the dtype's smallest value for masked positions.
             # Since we are adding it to the raw scores before the softmax, this is
             # effectively the same as removing these entirely.
-            attention_mask = attention_mask.to(dtype=self.dtype)  # fp16 compatibility
-            attention_mask = (1.0 - attention_mask) * torch.finfo(self.dtype).min
+            # self.dtype walks the parameters, look it up once; scale in place on the fresh (1 - mask) tensor
+            dtype = self.dtype
+            attention_mask = attention_mask.to(dtype=dtype)  # fp16 compatibility
+            attention_mask = (1.0 - attention_mask).mul_(torch.finfo(dtype).min)
 
         # If a 2D or 3D attention mask is provided for the cross-attention
         # we need to make broadcastable to [batch_size, num_heads, seq_length, seq_length]
@@ -129,7 +167,7 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         # 1.0 in head_mask indicate we keep the head
         # attention_probs has shape bsz x n_heads x N x N
         # head_mask has shape n_layer x batch x n_heads x N x N
-        head_mask = self.get_head_mask(head_mask, self.config.n_layer)
+        head_mask = self._none_head_mask if head_mask is None else self.get_head_mask(head_mask, n_layer)
 
         if inputs_embeds is None:
             inputs_embeds = self.wte(input_ids)
@@ -139,16 +177,7 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         """
         inputs_embeds = self.inject_after_embedding(inputs_embeds)
 
-        position_embeds = self.wpe(position_ids)
-        hidden_states = inputs_embeds + position_embeds
-
-        if token_type_ids is not None:
-            token_type_embeds = self.wte(token_type_ids)
-            hidden_states = hidden_states + token_type_embeds
-
-        hidden_states = self.drop(hidden_states)
-
-        output_shape = (-1,) + input_shape[1:] + (hidden_states.size(-1),)
+        hidden_states = self._get_embed_positions()(inputs_embeds, position_ids, token_type_ids)
 
         if self.gradient_checkpointing and self.training:
             if use_cache:
@@ -161,7 +190,8 @@ class GPT2SplitModel(GPT2Model, SplitModel):
         all_self_attentions = () if output_attentions else None
         all_cross_attentions = () if output_attentions and self.config.add_cross_attention else None
         all_hidden_states = () if output_hidden_states else None
-        for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
+        for i, block in enumerate(self.h[:n_layer]):
+            layer_past = None if past_key_values is None else past_key_values[i]
             # Model parallel
             if self.model_parallel:
                 torch.cuda.set_device(hidden_states.device)
@@ -235,7 +265,9 @@ class GPT2SplitModel(GPT2Model, SplitModel):
 
         hidden_states = self.ln_f(hidden_states)
 
-        hidden_states = hidden_states.view(output_shape)
+        if len(input_shape) != 2:
+            # inputs were flattened to (-1, seq_len) above, restore their shape (a no-op for 2-D inputs only)
+            hidden_states = hidden_states.view((-1,) + input_shape[1:] + (hidden_states.size(-1),))
         # Add last hidden state
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
@@ -4,6 +4,7 @@ from typing import Optional, Tuple, Union
 import regex
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.nn import CrossEntropyLoss, MSELoss, BCEWithLogitsLoss
 from transformers import GPT2LMHeadModel, GPT2ForSequenceClassification
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions, SequenceClassifierOutputWithPast
@@ -16,6 +17,10 @@ from sfl.utils.exp import register_model
 
 logger = logging.getLogger(__name__)
 
+_BLOCK_RE = regex.compile(r'\.h\.(\d+)')
+_ADAPTER_TAIL_RE = regex.compile(r'.*(.+attn|proj|fc)')
+_ADAPTER_EMBED_RE = regex.compile(r'.*(.+wte|wpe).*')
+
 
 class GPT2SplitWrapper(SplitWrapperModel):
 
@@ -23,28 +28,104 @@ class GPT2SplitWrapper(SplitWrapperModel):
         self.transformer.change_noise(scale, mode)
 
     @staticmethod
-    def _get_block_num(param_name: str):
-        r = regex.findall('\.h\.[0-9]+', param_name)
-        return int(r[0].split('.')[-1]) if len(r) > 0 else -1
-
-    def get_adapter_module_regex(self):
-        if self.fl_config is None:
-            return ""
+    def _parse_block_num(param_name: str):
+        m = _BLOCK_RE.search(param_name)
+        return int(m.group(1)) if m else -1
+
+    def _get_block_num(self, param_name: str):
+        # block numbers are cached by parameter name, names added later (e.g. LoRA) are parsed on first access
+        cache = self.__dict__.setdefault('_block_num_cache', {})
+        blk = cache.get(param_name)
+        if blk is None:
+            blk = cache[param_name] = self._parse_block_num(param_name)
+        return blk
+
+    def _get_adapter_blocks(self):
         blocks = []
         if self.fl_config.use_lora_at_bottom:
-            blocks += [str(i) for i in range(self.fl_config.split_point_1)]
+            blocks += list(range(self.fl_config.split_point_1))
         if self.fl_config.use_lora_at_trunk:
-            blocks += [str(i) for i in range(self.fl_config.split_point_1, self.fl_config.split_point_2)]
+            blocks += list(range(self.fl_config.split_point_1, self.fl_config.split_point_2))
         if self.fl_config.use_lora_at_top:
-            blocks += [str(i) for i in range(self.fl_config.split_point_2, self.config.n_layer)]
+            blocks += list(range(self.fl_config.split_point_2, self.config.n_layer))
+        return blocks
+
+    def get_adapter_module_regex(self):
+        if self.fl_config is None:
+            return ""
+        blocks = [str(i) for i in self._get_adapter_blocks()]
         reg = rf".*\.h\.({'|'.join(blocks)})\..*(.+attn|proj|fc)$"
         if self.fl_config.use_lora_at_embed:
             reg = rf"^({reg}|.*(.+wte|wpe).*)$"
         return reg
 
+    def get_adapter_modules(self):
+        """
+        Same modules as get_adapter_module_regex, resolved to exact names via a block-id set test
+        :return: list[str]
+        """
+        if self.fl_config is None:
+            return []
+        block_set = set(self._get_adapter_blocks())
+        names = []
+        for nm, _ in self.named_modules():
+            m = _BLOCK_RE.search(nm)
+            if m and int(m.group(1)) in block_set and nm[m.end():m.end() + 1] == '.' \
+                    and _ADAPTER_TAIL_RE.fullmatch(nm, m.end() + 1):
+                names.append(nm)
+            elif self.fl_config.use_lora_at_embed and _ADAPTER_EMBED_RE.fullmatch(nm):
+                names.append(nm)
+        return names
+
     def config_sfl(self, config: FLConfig, *args, **kwargs):
         super(GPT2SplitWrapper, self).config_sfl(config, *args, **kwargs)
         self.transformer.config_sfl(config, *args, **kwargs)
+        self._block_num_cache = {nm: self._parse_block_num(nm) for nm, _ in self.named_parameters()}
+        self._param_partition = None
+        self._partition_params()
+
+    def _partition_params(self):
+        """
+        Partition named_parameters() into (bottom, trunk, top) once.
+        Rebuilt when the split points or adapter state change; call config_sfl again after any other parameter change.
+        """
+        key = (self.fl_config.split_point_1, self.fl_config.split_point_2, self.adapter_added)
+        if self.__dict__.get('_param_partition') is not None and self._param_partition[0] == key:
+            return self._param_partition[1]
+        bottom, trunk, top = [], [], []
+        in_bottom, in_top = True, False
+        for nm, p in self.named_parameters():
+            blk = self._get_block_num(nm)
+            if blk >= self.fl_config.split_point_1:
+                in_bottom = False
+            if blk >= self.fl_config.split_point_2:
+                in_top = True
+            if in_bottom:
+                bottom.append((nm, p))
+            if in_top:
+                top.append((nm, p))
+            if self.fl_config.split_point_1 <= blk < self.fl_config.split_point_2:
+                trunk.append((nm, p))
+        self._param_partition = (key, (bottom, trunk, top))
+        return self._param_partition[1]
+
+    def get_bottom_params(self, trainable_only=True):
+        for nm, p in self._partition_params()[0]:
+            if trainable_only and not p.requires_grad:
+                continue
+            yield nm, p
+
+    def get_trunk_params(self, trainable_only=True):
+        for nm, p in self._partition_params()[1]:
+            if trainable_only and not p.requires_grad:
+                continue
+            yield nm, p
+
+    def get_top_params(self, trainable_only=True):
+        for nm, p in self._partition_params()[2]:
+            if trainable_only and not p.requires_grad:
+                continue
+            yield nm, p
 
     def get_all_inter(self, detach=True):
         return self.transformer.get_all_inter(detach)
@@ -75,6 +156,9 @@ class GPT2SplitLMHeadModel(GPT2LMHeadModel, GPT2SplitWrapper):
             return_dict: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithCrossAttentions]:
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        # under attack_mode the transformer returns the intercepted intermediate itself (not a model output),
+        # the LM head and the loss are skipped entirely
+        attack_mode = self.fl_config is not None and self.fl_config.attack_mode
 
         transformer_outputs = self.transformer(
             input_ids,
@@ -91,7 +175,7 @@ class GPT2SplitLMHeadModel(GPT2LMHeadModel, GPT2SplitWrapper):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
         )
-        if self.fl_config and self.fl_config.attack_mode:
+        if attack_mode:
             return transformer_outputs
         hidden_states = transformer_outputs[0]
 
@@ -106,12 +190,9 @@ class GPT2SplitLMHeadModel(GPT2LMHeadModel, GPT2SplitWrapper):
         if labels is not None:
             # move labels to correct device to enable model parallelism
             labels = labels.to(lm_logits.device)
-            # Shift so that tokens < n predict n
-            shift_logits = lm_logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = CrossEntropyLoss()
-            loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            # Shift so that tokens < n predict n, and flatten the tokens
+            # reshape only copies when the slice cannot be viewed (batch size > 1)
+            loss = F.cross_entropy(lm_logits[..., :-1, :].reshape(-1, lm_logits.size(-1)), labels[..., 1:].reshape(-1))
 
         if not return_dict:
             output = (lm_logits,) + transformer_outputs[1:]
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from functools import partial
 
 import regex
 import torch
@@ -13,6 +14,24 @@ from sfl.simulator.param_keeper import ParameterKeeper
 from sfl.utils.model import Intermediate, get_embedding_layer
 
 
+class SplitBoundary(torch.autograd.Function):
+    """
+    Identity at a split point: offloads the activation to host in forward and its gradient in backward
+    """
+
+    @staticmethod
+    def forward(ctx, x, model, layer_index):
+        model._offload_fx(layer_index, x)
+        ctx.model = model
+        ctx.layer_index = layer_index
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        ctx.model._offload_grad(ctx.layer_index, grad)
+        return grad, None, None
+
+
 class SplitModel(nn.Module, ABC):
     """
     The model simulated for three-part split SFL (private-label)
@@ -25,6 +44,9 @@ class SplitModel(nn.Module, ABC):
         self.adapter_added = False
         self.b2tr_hooks = []
         self.intermediate_fx = {}
+        self.intermediate_fx_host = {}  # host copies of intermediate_fx, offloaded during forward
+        self.intermediate_grads = {}  # gradients of intermediate_fx, offloaded to host during backward
+        self.intermediate_grads_device = {}  # the same gradients on device, returned by get_all_inter(detach=False)
         self.noise_mode = None
         self.dim_reducer = None
         self.perturbers = {}
@@ -60,10 +82,20 @@ class SplitModel(nn.Module, ABC):
         res = {}
         bt2tr = None
         tr2t = None
+        on_cuda = False
         for idx, v in self.intermediate_fx.items():
-            inter = Intermediate(v.detach().cpu() if detach and v is not None else v)
-            if v is not None and v.grad is not None:
-                inter.grad = v.grad.clone().detach().cpu() if detach else v.grad
+            if detach and v is not None:
+                # queue the D2H copies without blocking, synchronize once below
+                on_cuda = on_cuda or v.is_cuda
+                fx = self.intermediate_fx_host.get(idx)
+                inter = Intermediate(fx if fx is not None else v.detach().to('cpu', non_blocking=True))
+            else:
+                inter = Intermediate(v)
+            if idx in self.intermediate_grads:
+                inter.grad = self.intermediate_grads[idx] if detach else self.intermediate_grads_device[idx]
+            elif v is not None and (v.is_leaf or v.retains_grad) and v.grad is not None:
+                # only tensors that keep .grad are read, non-leaf .grad is always None (and warns)
+                inter.grad = v.grad.detach().to('cpu', non_blocking=True, copy=True) if detach else v.grad
             if idx == self.fl_config.split_point_1 - 1:
                 inter.type = 'b2tr'
                 bt2tr = inter
@@ -71,10 +103,56 @@ class SplitModel(nn.Module, ABC):
                 inter.type = 'tr2t'
                 tr2t = inter
             res[idx] = inter
+        if on_cuda:
+            torch.cuda.synchronize()
         return bt2tr, tr2t, res
 
     def _store_fx(self, layer_index, fx):
         self.intermediate_fx[layer_index] = fx
+        self.intermediate_fx_host.pop(layer_index, None)
+        self.intermediate_grads.pop(layer_index, None)
+        self.intermediate_grads_device.pop(layer_index, None)
+
+    def _store_split_fx(self, layer_index, to_save, hidden_states):
+        """
+        Store an intermediate to be communicated, and capture its gradient.
+        When it is the tensor passed on to the next block, a SplitBoundary is inserted so that both the activation
+        and its gradient are offloaded while the rest of the forward/backward runs.
+        The boundary's output is the stored tensor, so losses computed on it (e.g. dcor in 'dc' mode)
+        are part of the captured gradient, as with retain_grad()
+        """
+        self._store_fx(layer_index, to_save)
+        if self.noise_mode in ['grad', 'both'] or to_save is not hidden_states or not to_save.requires_grad:
+            self._retain_grad(layer_index, to_save)
+            return to_save, hidden_states
+        to_save = hidden_states = SplitBoundary.apply(to_save, self, layer_index)
+        self.intermediate_fx[layer_index] = to_save
+        return to_save, hidden_states
+
+    def _offload_fx(self, layer_index, fx):
+        fx = fx.detach()
+        self.intermediate_fx_host[layer_index] = fx.to('cpu', non_blocking=True) if fx.is_cuda else fx
+
+    def _retain_grad(self, layer_index, fx):
+        """
+        Capture the gradient of an intermediate during backward.
+        The 'grad' noise modes re-run backward from the device tensor and keep retain_grad(),
+        otherwise a hook queues the gradient's copy to pinned host memory while backward runs; the device gradient
+        stays referenced for get_all_inter(detach=False) until the next forward.
+        """
+        if self.noise_mode in ['grad', 'both']:
+            fx.retain_grad()
+        elif fx.requires_grad:
+            fx.register_hook(partial(self._offload_grad, layer_index))
+
+    def _offload_grad(self, layer_index, grad):
+        grad = grad.detach()
+        self.intermediate_grads_device[layer_index] = grad
+        if grad.is_cuda:
+            # a fresh pinned tensor per backward (served by the caching host allocator), so that gradients handed out
+            # by get_all_inter are never overwritten by the next step's copy
+            grad = torch.empty(grad.shape, dtype=grad.dtype, pin_memory=True).copy_(grad, non_blocking=True)
+        self.intermediate_grads[layer_index] = grad
 
     def inject_after_embedding(self, inputs_embeds):
         if self.inner_loop:
@@ -116,16 +194,13 @@ class SplitModel(nn.Module, ABC):
             to_save = hidden_states = self.perturbers[self.noise_mode](to_save)
         if self.training and self.fl_config is not None and self.fl_config.collect_intermediates:
             if i == self.fl_config.split_point_1 - 1:  # bottom-trunk
-                to_save.retain_grad()
-                self._store_fx(i, to_save)
+                to_save, hidden_states = self._store_split_fx(i, to_save, hidden_states)
                 for hook in self.b2tr_hooks:
                     hook(to_save)
             elif i == self.fl_config.split_point_2 - 1:  # trunk-top
-                to_save.retain_grad()
-                self._store_fx(i, to_save)
+                to_save, hidden_states = self._store_split_fx(i, to_save, hidden_states)
             elif self.fl_config.collect_all_layers:
-                to_save.retain_grad()
-                self._store_fx(i, to_save)
+                to_save, hidden_states = self._store_split_fx(i, to_save, hidden_states)
         return None, hidden_states
 
 
@@ -148,6 +223,13 @@ class SplitWrapperModel(SplitModel, ABC):
         """
         raise NotImplementedError
 
+    def get_adapter_modules(self):
+        """
+        Get the modules that need to be adapted by LoRA, in any form accepted by LoraConfig.target_modules
+        :return: str | list[str]
+        """
+        return self.get_adapter_module_regex()
+
     @abstractmethod
     def get_all_inter(self, detach=True):
         raise NotImplementedError
@@ -246,8 +328,9 @@ class SplitWrapperModel(SplitModel, ABC):
         if (not self.fl_config.use_lora_at_top) and (not self.fl_config.use_lora_at_bottom) and (
                 not self.fl_config.use_lora_at_trunk):
             return self
-        lora_config = LoraConfig(target_modules=self.get_adapter_module_regex())
+        lora_config = LoraConfig(target_modules=self.get_adapter_modules())
         res = get_peft_model(self, lora_config)
+        self.adapter_added = True
         if restore_rest:
             # PEFT will freeze all model parameters, need to restore the rest
             if not self.fl_config.use_lora_at_trunk:
@@ -262,5 +345,4 @@ class SplitWrapperModel(SplitModel, ABC):
                 for name, param in res.get_bottom_params(trainable_only=False):
                     if param.dtype == torch.float32:
                         param.requires_grad = True
-        self.adapter_added = True
         return res
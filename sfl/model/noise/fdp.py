@@ -0,0 +1,17 @@
+import torch
+
+from sfl.model.noise.base import Perturber
+
+
+class GaussianPerturber(Perturber):
+    """
+    Gaussian noise scaled by the value range of the perturbed hidden states
+    """
+
+    def forward(self, hidden_states):
+        if self.scale == 0:
+            return hidden_states
+        # one reduction for both ends, and the range stays on device (no host sync);
+        # not detached, so the gradient through the noise range is kept as with min()/max()
+        mn, mx = torch.aminmax(hidden_states)
+        return torch.addcmul(hidden_states, torch.randn_like(hidden_states), (mx - mn) * self.scale)
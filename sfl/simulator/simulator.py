@@ -108,12 +108,8 @@ class SFLSimulator(object):
             # re-initialize llm's params
             self.llm.init_weights()  # reset_params(self.llm.get_top_params(), config.top_and_bottom_from_scratch)
         if config.top_and_bottom_from_scratch == 'Noised':
-            for nm, param in self.llm.get_top_params():
-                scale = param.data.max() - param.data.min()
-                param.data += torch.randn_like(param.data) * scale * 0.02
-            for nm, param in self.llm.get_bottom_params():
-                scale = param.data.max() - param.data.min()
-                param.data += torch.randn_like(param.data) * scale * 0.02
+            noise_params([p for _, p in self.llm.get_top_params()] + [p for _, p in self.llm.get_bottom_params()],
+                         0.02)
 
         if not self.llm.adapter_added:
             self.llm = self.llm.convert_to_lora_model()
@@ -160,8 +156,8 @@ class SFLSimulator(object):
             for epc in range(999):
                 for step, batch in enumerate(data_loader):
                     optimizer.zero_grad()
-                    input_ids = batch['input_ids'].to(self.llm.device)
-                    attention_mask = batch['attention_mask'].to(self.llm.device)
+                    input_ids = batch['input_ids'].to(self.llm.device, non_blocking=True)
+                    attention_mask = batch['attention_mask'].to(self.llm.device, non_blocking=True)
                     outputs = self.llm(input_ids=input_ids, labels=input_ids, attention_mask=attention_mask)
                     loss = outputs.loss
                     pbar.set_description(f'Pre-FT Loss {loss.item():.3f}')
@@ -497,3 +493,14 @@ def config_dim_reducer(system_args, llm, tokenizer):
         return
     dim_reducer = get_dim_reducer(system_args, llm, tokenizer)
     llm.config_sfl(llm.fl_config, dim_reducer=dim_reducer)
+
+
+@torch.no_grad()
+def noise_params(params: list, ratio: float):
+    """
+    Add Gaussian noise scaled by each parameter's value range, in place and one parameter at a time,
+    so that only a single noise tensor is alive at once
+    """
+    for p in params:
+        mn, mx = torch.aminmax(p.data)
+        p.data.add_(torch.randn_like(p.data).mul_((mx - mn) * ratio))
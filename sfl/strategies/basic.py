@@ -47,11 +47,11 @@ class BaseSFLStrategy(FLStrategy):
                 if llm.type == 'encoder-decoder':
                     outputs = llm(**get_t5_input(batch, self.tokenizer, llm.device))
                 else:
-                    input_ids = batch['input_ids'].to(llm.device)
-                    attention_mask = batch['attention_mask'].to(llm.device)
+                    input_ids = batch['input_ids'].to(llm.device, non_blocking=True)
+                    attention_mask = batch['attention_mask'].to(llm.device, non_blocking=True)
                     labels = input_ids
                     if 'labels' in batch and (self.llm.task_type != 'lm' or self.args.completion_only):
-                        labels = batch['labels'].to(llm.device)
+                        labels = batch['labels'].to(llm.device, non_blocking=True)
                     outputs = llm(input_ids=input_ids, labels=labels, attention_mask=attention_mask)
 
                 loss = outputs.loss
@@ -4,7 +4,7 @@ import wandb
 
 from sfl.utils.args import FLConfig
 from sfl.strategies.basic import BaseSFLStrategy
-from sfl.utils.model import FLConfigHolder, Intermediate, evaluate_attacker_rouge
+from sfl.utils.model import FLConfigHolder, Intermediate, evaluate_attacker_rouge, evaluate_attacker_rouge_all
 
 
 class SLStrategyWithAttacker(BaseSFLStrategy):
@@ -81,9 +81,8 @@ class SLStrategyWithAttacker(BaseSFLStrategy):
                                          b2tr_inter,
                                          tr2t_inter, all_inter, init=init_map.get(init_from, None))
             if isinstance(attack_res, dict):
-                for key, logits in attack_res.items():
-                    init_map[f"{name}_{key}"] = logits
-                    eval_res = evaluate_attacker_rouge(self.tokenizer, logits, batch)
+                for key, eval_res in evaluate_attacker_rouge_all(self.tokenizer, attack_res, batch).items():
+                    init_map[f"{name}_{key}"] = attack_res[key]
                     self.__log_atk_res(eval_res, client_id, f"{name}_{key}")
             else:
                 eval_res = evaluate_attacker_rouge(self.tokenizer, attack_res, batch)
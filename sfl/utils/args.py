@@ -37,6 +37,7 @@ class FLConfig:
     batch_size: int = 2
     reducer_enable: bool = False
     lr: float = 2e-5
+    compile_embedding: bool = False  # torch.compile the position-embedding add + dropout chain
 
 
 
@@ -62,13 +62,26 @@ def lognormal_unbalance_split(num_clients, num_samples, unbalance_sgm):
 
 
 def random_slicing(dataset, num_clients, sgm=0):
-    dict_users, all_idxs = {}, [i for i in range(len(dataset))]
-    if num_clients > 0:
-        user_samples = lognormal_unbalance_split(num_clients, len(dataset), sgm)
-    for i in range(num_clients):
-        dict_users[i] = list(
-            np.random.choice(all_idxs, user_samples[i], replace=False))
-        all_idxs = list(set(all_idxs) - set(dict_users[i]))
+    """Randomly partition the sample indices of ``dataset`` into disjoint, log-normally unbalanced client slices.
+
+    Args:
+        dataset: Anything with ``len()``, e.g. ``np.arange(num_samples)``; only its length is used.
+        num_clients (int): Number of clients for partition.
+        sgm (float): Log-normal variance of the client sample numbers.
+
+    Returns:
+        dict: client number -> ``numpy.ndarray`` of sample indices.
+
+    """
+    dict_users = {}
+    if num_clients <= 0:
+        return dict_users
+    user_samples = lognormal_unbalance_split(num_clients, len(dataset), sgm)
+    # one permutation split at the cumulative sample numbers, same as drawing each client without replacement in turn
+    perm = np.random.permutation(len(dataset))
+    bounds = np.cumsum(user_samples)
+    for i, idxs in enumerate(np.split(perm[:bounds[-1]], bounds[:-1])):
+        dict_users[i] = idxs
     return dict_users
 
 
@@ -44,25 +44,63 @@ def decode_with_extra_space(tok, sent):
     return ' '.join(strs)
 
 
-def evaluate_attacker_rouge(tok, attacker_logits, batch):
+def decode_with_extra_space_batch(tok, sents):
+    """
+    decode_with_extra_space over a batch of id sequences, with one batch_decode call for all tokens
+    """
+    sents = torch.as_tensor(sents).cpu()
+    seq_len = sents.shape[-1]
+    if seq_len == 0:
+        return [''] * len(sents)
+    strs = tok.batch_decode(sents.reshape(-1, 1), skip_special_tokens=True)
+    return [' '.join(strs[i:i + seq_len]) for i in range(0, len(strs), seq_len)]
+
+
+def _attacker_eval_ids(tok, attacker_logits, batch):
+    """
+    Attacked and ground-truth token ids to be compared; with input_santi_mask, only the sensitive tokens are kept
+    """
+    atk_ids = attacker_logits.argmax(dim=-1)
+    gt_ids = batch['input_ids']
     if 'input_santi_mask' in batch:  # 只评估敏感词
         mask = batch['input_santi_mask']
         zero_indexes = torch.where(mask == 0)
-        masked_atk_ids = attacker_logits.argmax(dim=-1)
-        masked_atk_ids[zero_indexes] = tok.unk_token_id
-        masked_gt_ids = batch['input_ids'].clone()
-        masked_gt_ids[zero_indexes] = tok.unk_token_id
-        atk_txts = [decode_with_extra_space(tok, s) for s in masked_atk_ids]
-        gt_txts = [decode_with_extra_space(tok, s) for s in masked_gt_ids]
-    else:
-        atk_txts = [decode_with_extra_space(tok, s) for s in attacker_logits.argmax(dim=-1)]
-        gt_txts = [decode_with_extra_space(tok, s) for s in batch['input_ids']]  # batch['input_text']
+        atk_ids[zero_indexes] = tok.unk_token_id
+        gt_ids = gt_ids.clone()
+        gt_ids[zero_indexes] = tok.unk_token_id
+    return atk_ids, gt_ids
+
+
+def _evaluate_attacker_texts(tok, atk_txts, gt_txts):
     rouge = calculate_rouge_text(atk_txts, gt_txts, print_comparison=False)
     meteor = calculate_meteor(atk_txts, gt_txts)
     token_acc = calculate_token_acc(tok, atk_txts, gt_txts)
     return rouge, meteor, token_acc
 
 
+def evaluate_attacker_rouge(tok, attacker_logits, batch):
+    atk_ids, gt_ids = _attacker_eval_ids(tok, attacker_logits, batch)
+    atk_txts = decode_with_extra_space_batch(tok, atk_ids)
+    gt_txts = decode_with_extra_space_batch(tok, gt_ids)  # batch['input_text']
+    return _evaluate_attacker_texts(tok, atk_txts, gt_txts)
+
+
+def evaluate_attacker_rouge_all(tok, attacker_logits: dict[Any, torch.Tensor], batch):
+    """
+    evaluate_attacker_rouge for several attack results (e.g. one per layer) on the same batch,
+    the ground truth is decoded only once
+    :return: dict of key -> (rouge, meteor, token_acc)
+    """
+    res = {}
+    gt_txts = None
+    for key, logits in attacker_logits.items():
+        atk_ids, gt_ids = _attacker_eval_ids(tok, logits, batch)
+        if gt_txts is None:
+            gt_txts = decode_with_extra_space_batch(tok, gt_ids)
+        res[key] = _evaluate_attacker_texts(tok, decode_with_extra_space_batch(tok, atk_ids), gt_txts)
+    return res
+
+
 def calculate_token_acc(tok, texts, labels):
     f1_avg = 0
     for g, r in zip(texts, labels):
@@ -248,6 +286,34 @@ def get_best_gpu():
     return torch.device("cuda:%d" % (best_device_index))
 
 
+def prefetch_to_device(tensors, device):
+    """
+    Yield tensors moved to device in order.
+    On CUDA, the copy of the next tensor is issued from pinned memory on a side stream while the current one is consumed.
+    """
+    device = torch.device(device)
+    if device.type != 'cuda' or len(tensors) == 0:
+        for t in tensors:
+            yield t.to(device)
+        return
+    stream = torch.cuda.Stream(device)
+    main_stream = torch.cuda.current_stream(device)
+
+    def _issue(t):
+        if not t.is_cuda:
+            t = t.pin_memory()
+        with torch.cuda.stream(stream):
+            return t.to(device, non_blocking=True)
+
+    nxt = _issue(tensors[0])
+    for i in range(len(tensors)):
+        cur = nxt
+        main_stream.wait_stream(stream)
+        cur.record_stream(main_stream)
+        nxt = _issue(tensors[i + 1]) if i + 1 < len(tensors) else None
+        yield cur
+
+
 def set_random_seed(SEED):
     random.seed(SEED)
     np.random.seed(SEED)